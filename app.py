@@ -1,10 +1,23 @@
+"""Streamlit front end for the offline RAG code assistant.
+
+GPU memory is deliberately not released between requests: PyTorch's
+CUDACachingAllocator already amortizes allocations by reusing freed blocks,
+and calling ``torch.cuda.empty_cache()`` forces a device sync and throws that
+cache away. The cache is only cleared on an explicit database refresh or to
+recover from an out-of-memory error.
+"""
 import os
+import atexit
 import logging
+import queue
+import threading
 import time
-from typing import Tuple
+from array import array
+from typing import List, Optional, Tuple
 import psutil
 import warnings
-from contextlib import nullcontext, contextmanager
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 # Set offline environment variables
 os.environ['HF_HUB_OFFLINE'] = '1'
@@ -16,20 +29,52 @@ warnings.filterwarnings("ignore", message=".*torch.classes.*")
 
 # Import torch after setting warnings
 import torch
-import GPUtil
 import streamlit as st
 from database import DocumentDatabase
-from utils import CodeGenerator, PerformanceMonitor, clear_memory, GPUManager
+from utils import CodeGenerator, PerformanceMonitor, LRUCache, GPUManager, GENERATION_ERROR_PREFIX
 
-# Configure logging
-logging.basicConfig(
-    filename='app_performance.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Enable TF32 matmuls and cuDNN autotuning for every forward pass
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+@st.cache_resource(show_spinner=False)
+def init_logging() -> Optional[QueueListener]:
+    """Route log records through a queue so file I/O happens off the request thread
+
+    Cached as a resource so reruns do not stack extra handlers or listener threads.
+    Returns None if the queue is already installed.
+    """
+    root = logging.getLogger()
+    # "Clear cache" also clears cache_resource, so check the handlers themselves too
+    if any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return None
+    
+    # Keep whatever file handlers imported modules installed, just move them behind the queue
+    handlers = root.handlers[:]
+    if not handlers:
+        file_handler = logging.FileHandler('app_performance.log')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers = [file_handler]
+    for handler in handlers:
+        root.removeHandler(handler)
+    
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    return listener
+
+@st.cache_resource(show_spinner=False)
+def get_monitor() -> PerformanceMonitor:
+    """Shared performance monitor, created once per process"""
+    return PerformanceMonitor()
 
-# Initialize performance monitor
-monitor = PerformanceMonitor()
+# Configure logging
+init_logging()
 
 @contextmanager
 def suppress_warnings():
@@ -39,127 +84,316 @@ def suppress_warnings():
     yield
     logging.getLogger("transformers").setLevel(logging.WARNING)
 
-def configure_torch():
-    """Configure PyTorch settings"""
+@st.cache_resource(show_spinner=False)
+def get_gpu_info() -> dict:
+    """Probe the device once per process; the name and CUDA version never change"""
     if torch.cuda.is_available():
-        # Configure CUDA settings
-        torch.backends.cudnn.benchmark = True
-        torch.backends.cudnn.deterministic = False
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-        
-        # Set default tensor type
-        torch.set_default_tensor_type('torch.cuda.FloatTensor')
-        
-        # Clear cache
-        torch.cuda.empty_cache()
-        
         return {
             "device": "cuda",
             "device_name": torch.cuda.get_device_name(0),
             "cuda_version": torch.version.cuda,
             "gpu_available": True
         }
+    return {
+        "device": "cpu",
+        "device_name": "CPU",
+        "cuda_version": None,
+        "gpu_available": False
+    }
+
+def configure_torch():
+    """Configure PyTorch settings"""
+    gpu_info = get_gpu_info()
+    if gpu_info["gpu_available"]:
+        # Configure CUDA settings
+        torch.backends.cudnn.deterministic = False
+        
+        # Set default tensor type
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
     else:
         torch.set_default_tensor_type('torch.FloatTensor')
-        return {
-            "device": "cpu",
-            "device_name": "CPU",
-            "cuda_version": None,
-            "gpu_available": False
-        }
+    return gpu_info
+
+class _StatsSampler:
+    """Sample GPU/CPU statistics on a background thread so reruns never block on nvidia-smi
+
+    Sampling pauses once the stats have not been read for idle_timeout seconds, so the
+    thread does not keep polling the GPU after every session hides them.
+    """
+    def __init__(self, interval: float = 1.0, idle_timeout: float = 10.0):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self._stop = threading.Event()
+        self._active = threading.Event()
+        self._active.set()
+        self._last_read = time.monotonic()
+        self.snapshot = self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def read(self):
+        """Return the latest snapshot without blocking, resuming sampling if it was paused"""
+        self._last_read = time.monotonic()
+        if not self._active.is_set():
+            # Wake the thread to refresh it; the paused snapshot is flagged until then
+            self._active.set()
+            return {**self.snapshot, "Status": "Stale, refreshing"}
+        return self.snapshot
+
+    def _sample(self):
+        stats = {}
+        
+        # GPU Stats
+        gpu_info = get_gpu_info()
+        if gpu_info["gpu_available"]:
+            try:
+                # Imported lazily so CPU-only hosts never load GPUtil
+                import GPUtil
+                gpu = GPUtil.getGPUs()[0]
+                stats.update({
+                    "GPU Device": gpu_info["device_name"],
+                    "GPU Memory": f"{gpu.memoryUsed:.0f}MB / {gpu.memoryTotal:.0f}MB",
+                    "GPU Util": f"{gpu.load*100:.1f}%",
+                    "CUDA Ver": gpu_info["cuda_version"]
+                })
+            except Exception as e:
+                # Only log the first failure, the sampler retries every interval
+                if "GPU Error" not in getattr(self, "snapshot", {}):
+                    logging.error("Error getting GPU stats: %s", e)
+                stats.update({"GPU Error": str(e)})
+        
+        # CPU Stats
+        stats.update({
+            "CPU Usage": f"{psutil.cpu_percent(interval=None)}%",
+            "RAM Usage": f"{psutil.virtual_memory().percent}%"
+        })
+        
+        return stats
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if time.monotonic() - self._last_read > self.idle_timeout:
+                # Nobody is looking, sleep until the next read() or stop(), then sample at once
+                self._active.clear()
+                self._active.wait()
+                if self._stop.is_set():
+                    return
+            self.snapshot = self._sample()
+
+    def stop(self):
+        self._stop.set()
+        self._active.set()
+
+@st.cache_resource
+def get_stats_sampler() -> _StatsSampler:
+    """Start the system stats sampler once per process"""
+    return _StatsSampler()
 
 def get_system_stats():
-    """Get current system statistics including GPU"""
-    stats = {}
-    
-    # GPU Stats
-    if torch.cuda.is_available():
-        try:
-            gpu = GPUtil.getGPUs()[0]
-            stats.update({
-                "GPU Device": torch.cuda.get_device_name(0),
-                "GPU Memory": f"{gpu.memoryUsed:.0f}MB / {gpu.memoryTotal:.0f}MB",
-                "GPU Util": f"{gpu.load*100:.1f}%",
-                "CUDA Ver": torch.version.cuda
-            })
-        except Exception as e:
-            logging.error(f"Error getting GPU stats: {e}")
-            stats.update({"GPU Error": str(e)})
-    
-    # CPU Stats
-    stats.update({
-        "CPU Usage": f"{psutil.cpu_percent()}%",
-        "RAM Usage": f"{psutil.virtual_memory().percent}%"
-    })
-    
-    return stats
+    """Get the latest sampled system statistics including GPU"""
+    return get_stats_sampler().read()
 
 @st.cache_resource(ttl=3600)
 def init_components() -> Tuple[DocumentDatabase, CodeGenerator]:
     """Initialize and cache the main components"""
     try:
-        monitor.start("init_components")
+        get_monitor().start("init_components")
         
-        # Configure torch
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.backends.cudnn.benchmark = True
-            device = torch.device("cuda")
-            logging.info(f"Using CUDA device: {torch.cuda.get_device_name(0)}")
+        # Log the device the components will load onto
+        gpu_info = get_gpu_info()
+        if gpu_info["gpu_available"]:
+            logging.info("Using CUDA device: %s", gpu_info["device_name"])
         else:
-            device = torch.device("cpu")
             logging.info("Using CPU device")
         
-        # Initialize components
-        db = DocumentDatabase().create_or_load_db()
+        # Initialize components; the database stores chunk token IDs from the generator's tokenizer
         generator = CodeGenerator()
+        db = DocumentDatabase(tokenizer_name=generator.model_name)
+        db.create_or_load_db()
         
-        monitor.end("init_components")
+        get_monitor().end("init_components")
         return db, generator
         
     except Exception as e:
-        logging.error(f"Error initializing components: {str(e)}")
+        logging.error("Error initializing components: %s", e)
         st.error(f"Error initializing components: {str(e)}")
         return None, None
 
-@st.cache_data(ttl=300)
-def get_similar_docs(_db, query: str, k: int = 3):
-    """Cache similarity search results"""
-    monitor.start("similarity_search")
-    docs = _db.similarity_search(query, k=k)
-    monitor.end("similarity_search")
+@st.cache_data(ttl=300, max_entries=512, hash_funcs={DocumentDatabase: id})
+def embed_query_cached(db: DocumentDatabase, query: str):
+    """Cache query embeddings so repeated queries skip the embedding model"""
+    return db.embed_query(query)
+
+def get_similar_docs(db: DocumentDatabase, query: str, k: int = 3):
+    """Search documentation using the cached query embedding"""
+    get_monitor().start("similarity_search")
+    docs = db.similarity_search_by_vector(embed_query_cached(db, query), k=k)
+    get_monitor().end("similarity_search")
     return docs
 
-@st.cache_data(ttl=300)
-def generate_code_cached(_generator, prompt: str, max_length: int, language: str):
+def run_with_oom_retry(func, *args):
+    """Run a generation call, clearing the CUDA cache and retrying once on OOM"""
+    try:
+        return func(*args)
+    except torch.cuda.OutOfMemoryError:
+        logging.warning("CUDA out of memory during generation, retrying after clearing cache")
+        GPUManager.clear_memory()
+        return func(*args)
+
+def generate_batched(generator, prompts, max_lengths, num_sequences=None):
+    """Submit prompts to the shared micro-batcher and wait for all completions"""
+    if num_sequences is None:
+        num_sequences = [1] * len(prompts)
+    futures = [
+        generator.submit(prompt, length, count)
+        for prompt, length, count in zip(prompts, max_lengths, num_sequences)
+    ]
+    return [future.result() for future in futures]
+
+@st.cache_resource
+def get_generation_cache() -> LRUCache:
+    """Process-wide cache of (code, explanation) results, shared across sessions"""
+    return LRUCache(max_entries=256)
+
+def generation_key(prompt_ids: List[int], max_length: int, include_explanation: bool, variants: int = 1) -> bytes:
+    """Compact digest key for a generation request"""
+    return LRUCache.make_key(array("i", prompt_ids).tobytes(), max_length, include_explanation, variants)
+
+def generate_code_cached(generator, prompt_ids: List[int], max_length: int):
     """Cache code generation results"""
-    monitor.start("code_generation")
+    cache = get_generation_cache()
+    key = generation_key(prompt_ids, max_length, False)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached[0]
     
-    # Create a structured prompt
-    structured_prompt = f"""
-Task: Create {language} code for the following requirement:
-{prompt}
-
-Requirements:
-1. Use clean, readable {language} code
-2. Include comprehensive comments
-3. Follow {language} best practices
-4. Implement proper error handling
-5. Use meaningful variable/function names
-
-Additional Context:
-- Code should be well-structured and maintainable
-- Include necessary imports/dependencies
-- Add input validation where appropriate
-- Consider edge cases
-
-Please provide the implementation below:
-"""
+    get_monitor().start("code_generation")
+    ((code_output,),) = run_with_oom_retry(generate_batched, generator, [prompt_ids], [max_length])
+    generated_code = generator.postprocess_code(code_output)
+    get_monitor().end("code_generation")
+    
+    cache.put(key, (generated_code, None))
+    return generated_code
+
+def generate_with_explanation_cached(generator, prompt_ids: List[int], max_length: int, language: str):
+    """Cache code and an explanation that reuses the code generation's KV cache
+
+    The explanation must describe the code the user is shown, so it always runs after
+    code generation instead of being batched alongside it.
+    """
+    cache = get_generation_cache()
+    key = generation_key(prompt_ids, max_length, True)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
     
-    result = _generator.generate_code(structured_prompt, max_length, language)
-    monitor.end("code_generation")
-    return result
+    get_monitor().start("code_generation")
+    generated_code, generation = run_with_oom_retry(
+        generator.generate_code,
+        prompt_ids,
+        max_length,
+        language,
+        True
+    )
+    get_monitor().end("code_generation")
+    
+    if generation is None:
+        return generated_code, "No explanation available because code generation failed."
+    
+    get_monitor().start("explanation_generation")
+    # No OOM retry here: a failed generate may already have extended the cache in place
+    explanation = generator.explain_from_cache(generation, language)
+    get_monitor().end("explanation_generation")
+    
+    cache.put(key, (generated_code, explanation))
+    return generated_code, explanation
+
+def generate_variants_cached(generator, prompt_ids: List[int], max_length: int, language: str, variants: int, include_explanation: bool):
+    """Cache several (code, explanation) variants sampled from a single prefill"""
+    cache = get_generation_cache()
+    key = generation_key(prompt_ids, max_length, include_explanation, variants)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    
+    get_monitor().start("code_generation")
+    if include_explanation:
+        codes, generation = run_with_oom_retry(
+            generator.generate_code,
+            prompt_ids,
+            max_length,
+            language,
+            True,
+            variants
+        )
+        get_monitor().end("code_generation")
+        if generation is None:
+            return [(codes, "No explanation available because code generation failed.")]
+        
+        # Failed variants get a placeholder rather than decode steps spent on their raw tokens
+        valid = [i for i, code in enumerate(codes) if not code.startswith(GENERATION_ERROR_PREFIX)]
+        explanations = ["No explanation available because code generation failed."] * len(codes)
+        if valid:
+            get_monitor().start("explanation_generation")
+            explained = generator.explain_from_cache(generation, language, rows=valid)
+            for i, explanation in zip(valid, explained):
+                explanations[i] = explanation
+            get_monitor().end("explanation_generation")
+    else:
+        (completions,) = run_with_oom_retry(generate_batched, generator, [prompt_ids], [max_length], [variants])
+        codes = generator.postprocess_variants(completions)
+        explanations = [None] * len(codes)
+        get_monitor().end("code_generation")
+    
+    results = list(zip(codes, explanations))
+    # Like the single-result paths, never replay a failure to other sessions
+    if not any(code.startswith(GENERATION_ERROR_PREFIX) for code in codes):
+        cache.put(key, results)
+    return results
+
+def stream_generation(generator, placeholder, prompt_ids: List[int], max_length: int, language: str, include_explanation: bool):
+    """Render code into the placeholder as it streams, then cache the finished result
+
+    A generator cannot be memoized directly, so the completed result is written to
+    the shared generation cache after streaming finishes.
+    """
+    cache = get_generation_cache()
+    key = generation_key(prompt_ids, max_length, include_explanation)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    
+    get_monitor().start("code_generation")
+    for attempt in range(2):
+        result = {} if include_explanation else None
+        streamed = ""
+        stream = generator.generate_code_stream(prompt_ids, max_length, language, result)
+        try:
+            for chunk in stream:
+                streamed += chunk
+                placeholder.code(streamed, language=language.lower())
+        except torch.cuda.OutOfMemoryError:
+            # Only retry while nothing has been shown, a partial stream cannot be restarted
+            if streamed or attempt:
+                raise
+            logging.warning("CUDA out of memory before streaming started, retrying after clearing cache")
+            GPUManager.clear_memory()
+            continue
+        finally:
+            # Stops the background generation when Streamlit interrupts the script mid-stream
+            stream.close()
+        break
+    generated_code = generator.postprocess_code(streamed)
+    get_monitor().end("code_generation")
+    
+    explanation = None
+    if include_explanation:
+        get_monitor().start("explanation_generation")
+        explanation = generator.explain_from_cache(result["generation"], language)
+        get_monitor().end("explanation_generation")
+    
+    cache.put(key, (generated_code, explanation))
+    return generated_code, explanation
 
 def main():
     # Configure PyTorch
@@ -173,7 +407,7 @@ def main():
         initial_sidebar_state="expanded"
     )
     
-    monitor.start("app_startup")
+    get_monitor().start("app_startup")
     
     # Display device information
     if torch_config["gpu_available"]:
@@ -216,19 +450,27 @@ def main():
             step=50
         )
         
+        # Variants share one prefill, so extra ones cost far less than separate requests
+        variants = st.slider(
+            "Variants",
+            min_value=1,
+            max_value=4,
+            value=1
+        )
+        
         # Database management
         st.header("Database Management")
         if st.button("Refresh Documentation Database"):
             try:
                 with st.spinner("Refreshing database..."):
-                    monitor.start("refresh_database")
-                    db = DocumentDatabase().refresh_database()
-                    monitor.end("refresh_database")
+                    get_monitor().start("refresh_database")
+                    db.refresh_database()
+                    get_monitor().end("refresh_database")
                 st.success("Database refreshed successfully!")
                 if torch_config["gpu_available"]:
                     GPUManager.clear_memory()
             except Exception as e:
-                logging.error(f"Error refreshing database: {str(e)}")
+                logging.error("Error refreshing database: %s", e)
                 st.error(f"Error refreshing database: {str(e)}")
     
     # Main interface
@@ -247,73 +489,79 @@ def main():
     with col2:
         st.markdown("### Options")
         generate_button = st.button("Generate Code", type="primary")
-        include_explanation = st.checkbox("Include explanation", value=True)
+        include_explanation = st.checkbox(
+            "Include explanation",
+            value=True,
+            help="Explanations continue from the code's KV cache, so these requests are not batched with other sessions"
+        )
+        # Off by default: streamed requests hold the model for their whole decode and skip
+        # the micro-batcher that shares generate calls between concurrent sessions
+        stream_output = st.checkbox(
+            "Stream output",
+            value=False,
+            help="Show code as it is generated; streamed requests run one at a time instead of being batched"
+        )
         show_context = st.checkbox("Show reference docs", value=False)
     
     if generate_button and user_query:
         try:
-            # Clear GPU memory before generation
-            if torch_config["gpu_available"]:
-                GPUManager.clear_memory()
-            
             # Search documentation
             with st.spinner("Searching documentation..."):
                 docs = get_similar_docs(db, user_query)
-                context = "\n".join([doc.page_content for doc in docs])
-            
-            # Create prompt with context
-            prompt = f"""
-Based on the following documentation and requirements:
-
-Documentation Reference:
-{context}
-
-User Request:
-{user_query}
-
-Technical Requirements:
-1. Language: {language}
-2. Include error handling
-3. Add input validation
-4. Use proper documentation
-5. Follow coding standards
-
-Please generate a complete, well-documented solution.
-"""
             
-            # Generate code
-            with st.spinner("Generating code..."):
-                generated_code = generate_code_cached(generator, prompt, max_length, language)
-                
-                st.subheader("Generated Code")
-                st.code(generated_code, language=language.lower())
-                
-                # Add copy button
-                if st.button("📋 Copy Code"):
-                    st.write(st.clipboard.copy(generated_code))
-                    st.success("Code copied to clipboard!")
+            # Build prompt token IDs from the pre-tokenized template and the chunks' stored IDs
+            prompt_ids = generator.encode_prompt(language, user_query, context_ids=db.context_ids(docs))
             
-            # Generate explanation if requested
-            if include_explanation:
-                with st.spinner("Generating explanation..."):
-                    explanation_prompt = f"""
-Explain this {language} code in detail:
-
-{generated_code}
-
-Focus on:
-1. Overall purpose and functionality
-2. Key components and their interactions
-3. Important implementation details
-4. Error handling and edge cases
-5. Any assumptions or limitations
-"""
-                    explanation = generate_code_cached(
+            # Generate code, continuing into the explanation from the same KV cache if requested
+            st.subheader("Generated Code")
+            if variants > 1:
+                with st.spinner("Generating code variants..."):
+                    results = generate_variants_cached(
                         generator,
-                        explanation_prompt,
-                        300,
-                        language
+                        prompt_ids,
+                        max_length,
+                        language,
+                        variants,
+                        include_explanation
                     )
+                
+                tabs = st.tabs([f"Variant {i}" for i in range(1, len(results) + 1)])
+                for tab, (generated_code, explanation) in zip(tabs, results):
+                    with tab:
+                        st.code(generated_code, language=language.lower())
+                        if include_explanation:
+                            st.markdown("**Code Explanation**")
+                            st.write(explanation)
+            else:
+                code_placeholder = st.empty()
+                with st.spinner("Generating code..."):
+                    if stream_output:
+                        generated_code, explanation = stream_generation(
+                            generator,
+                            code_placeholder,
+                            prompt_ids,
+                            max_length,
+                            language,
+                            include_explanation
+                        )
+                    elif include_explanation:
+                        generated_code, explanation = generate_with_explanation_cached(
+                            generator,
+                            prompt_ids,
+                            max_length,
+                            language
+                        )
+                    else:
+                        generated_code = generate_code_cached(generator, prompt_ids, max_length)
+                    
+                    code_placeholder.code(generated_code, language=language.lower())
+                    
+                    # Add copy button
+                    if st.button("📋 Copy Code"):
+                        st.write(st.clipboard.copy(generated_code))
+                        st.success("Code copied to clipboard!")
+                
+                if include_explanation:
                     st.subheader("Code Explanation")
                     st.write(explanation)
             
@@ -324,12 +572,8 @@ Focus on:
                         st.markdown(f"**Reference {i}:**")
                         st.text(doc.page_content)
             
-            # Clear GPU memory after generation
-            if torch_config["gpu_available"]:
-                GPUManager.clear_memory()
-            
         except Exception as e:
-            logging.error(f"Error during code generation: {str(e)}")
+            logging.error("Error during code generation: %s", e)
             st.error(f"An error occurred: {str(e)}")
     
     # Footer
@@ -346,12 +590,12 @@ Focus on:
         unsafe_allow_html=True
     )
     
-    monitor.end("app_startup")
+    get_monitor().end("app_startup")
 
 if __name__ == "__main__":
     try:
         with suppress_warnings():
             main()
     except Exception as e:
-        logging.error(f"Application error: {str(e)}")
+        logging.error("Application error: %s", e)
         st.error("An unexpected error occurred. Please check the logs for details.")
\ No newline at end of file
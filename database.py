@@ -2,12 +2,16 @@ from langchain_community.document_loaders import DirectoryLoader
 from langchain_community.document_loaders import PDFPlumberLoader
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from transformers import AutoTokenizer
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import os
 import logging
 import chardet
 import pickle
 import time
+import weakref
+import faiss
+import numpy as np
 import torch
 import warnings
 from typing import List, Optional, Dict, Any
@@ -24,6 +28,9 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Imported after logging is configured so utils' basicConfig does not claim the root logger
+from utils import MicroBatcher, MODEL_NAME
+
 class CustomTextLoader:
     """Custom text loader that handles different encodings"""
     def __init__(self, file_path: str):
@@ -56,7 +63,7 @@ class CustomTextLoader:
 class DocumentDatabase:
     """Manages document loading, processing, and vector storage with GPU support"""
     
-    def __init__(self):
+    def __init__(self, tokenizer_name: str = MODEL_NAME):
         self.cache_dir = "./cache"
         self.models_dir = "./models"
         os.makedirs(self.cache_dir, exist_ok=True)
@@ -80,6 +87,24 @@ class DocumentDatabase:
         self.chunk_size = 1000
         self.chunk_overlap = 200
         
+        # Generator tokenizer, used to store each chunk's token IDs alongside its text. Pass
+        # the generator's model_name so the stored IDs match the model they are fed to.
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, local_files_only=True)
+        self.tokenizer_id = self.fingerprint_tokenizer(self.tokenizer)
+        self.newline_ids = self.tokenizer("\n", add_special_tokens=False).input_ids
+        
+        # Vector store is populated by create_or_load_db()
+        self.vectorstore = None
+        self.gpu_resources = None
+        
+        # Batch concurrent searches into one embedding pass and one index.search call
+        search_fn = weakref.WeakMethod(self._search_batch)
+        self.search_batcher = MicroBatcher(
+            lambda queries, ks: search_fn()(queries, ks),
+            max_batch_size=16,
+            max_latency=0.005
+        )
+        
         logging.info("DocumentDatabase initialized")
 
     def load_pdf(self, file_path: str) -> List[Document]:
@@ -197,6 +222,7 @@ class DocumentDatabase:
                     raise ValueError("No texts were extracted from documents.")
                 
                 logging.info("Creating new vector database...")
+                self.attach_token_ids(texts)
                 db = FAISS.from_documents(texts, self.embeddings)
                 db.save_local(self.index_file)
                 
@@ -205,7 +231,14 @@ class DocumentDatabase:
             else:
                 logging.info("Loading existing vector database...")
                 db = FAISS.load_local(self.index_file, self.embeddings)
+                
+                # Chunks without IDs from the current tokenizer are tokenized in memory only,
+                # so loading never rewrites the saved index
+                self.attach_token_ids(list(db.docstore._dict.values()))
             
+            # Move to GPU only after saving, GPU indexes cannot be serialized directly
+            self.vectorstore = db
+            self.move_index_to_gpu()
             return db
             
         except Exception as e:
@@ -213,6 +246,96 @@ class DocumentDatabase:
             logging.error(error_msg)
             raise ValueError(error_msg)
 
+    @staticmethod
+    def fingerprint_tokenizer(tokenizer) -> str:
+        """Identify a tokenizer by its name and vocabulary size"""
+        return f"{tokenizer.name_or_path}:{len(tokenizer)}"
+
+    def attach_token_ids(self, documents: List[Document]) -> int:
+        """Store generator token IDs in each chunk's metadata; returns how many were (re)tokenized
+
+        Chunks tokenized by a different tokenizer, e.g. before the generator model changed,
+        are tokenized again instead of splicing mismatched IDs into prompts.
+        """
+        stale = [doc for doc in documents if doc.metadata.get("tokenizer") != self.tokenizer_id]
+        if not stale:
+            return 0
+        
+        mismatched = sum(1 for doc in stale if "input_ids" in doc.metadata)
+        if mismatched:
+            logging.warning(f"Re-tokenizing {mismatched} chunks whose token IDs came from a different tokenizer")
+        
+        encoded = self.tokenizer([doc.page_content for doc in stale], add_special_tokens=False)
+        for doc, input_ids in zip(stale, encoded.input_ids):
+            doc.metadata["input_ids"] = input_ids
+            doc.metadata["tokenizer"] = self.tokenizer_id
+        logging.info(f"Tokenized {len(stale)} document chunks")
+        return len(stale)
+
+    def context_ids(self, documents: List[Document]) -> List[int]:
+        """Join the stored token IDs of retrieved chunks with newlines, like joining their text"""
+        self.attach_token_ids(documents)
+        input_ids = []
+        for i, doc in enumerate(documents):
+            if i:
+                input_ids.extend(self.newline_ids)
+            input_ids.extend(doc.metadata["input_ids"])
+        return input_ids
+
+    def move_index_to_gpu(self):
+        """Move the FAISS index onto the GPU when faiss was built with GPU support"""
+        if self.device != "cuda" or not hasattr(faiss, "StandardGpuResources"):
+            return
+        try:
+            self.gpu_resources = faiss.StandardGpuResources()
+            self.vectorstore.index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, self.vectorstore.index)
+            logging.info("Moved FAISS index to GPU")
+        except Exception as e:
+            logging.warning(f"Keeping FAISS index on CPU: {str(e)}")
+
+    @torch.inference_mode()
+    def embed_query(self, query: str) -> np.ndarray:
+        """Embed a query with the same model used to build the index"""
+        return np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+
+    def similarity_search_by_vectors(self, embeddings: np.ndarray, k: int = 3) -> List[List[Document]]:
+        """Search a (B, d) matrix of query embeddings with one index.search call"""
+        if self.vectorstore is None:
+            raise ValueError("Vector database has not been loaded")
+        
+        _, indices = self.vectorstore.index.search(np.ascontiguousarray(embeddings, dtype=np.float32), k)
+        
+        results = []
+        for row in indices:
+            docs = []
+            for index in row:
+                # FAISS pads with -1 when fewer than k vectors are available
+                if index == -1:
+                    continue
+                doc_id = self.vectorstore.index_to_docstore_id[index]
+                docs.append(self.vectorstore.docstore.search(doc_id))
+            results.append(docs)
+        return results
+
+    @torch.inference_mode()
+    def similarity_search_batch(self, queries: List[str], k: int = 3) -> List[List[Document]]:
+        """Search several queries with one embedding pass and one index.search call"""
+        embeddings = np.asarray(self.embeddings.embed_documents(queries), dtype=np.float32)
+        return self.similarity_search_by_vectors(embeddings, k)
+
+    def _search_batch(self, embeddings: List[np.ndarray], ks: List[int]) -> List[List[Document]]:
+        """Micro-batcher callback: search at the largest k and trim each result"""
+        results = self.similarity_search_by_vectors(np.stack(embeddings), max(ks))
+        return [docs[:k] for docs, k in zip(results, ks)]
+
+    def similarity_search_by_vector(self, embedding: np.ndarray, k: int = 3) -> List[Document]:
+        """Search for one precomputed embedding, sharing the index call with concurrent requests"""
+        return self.search_batcher.submit(embedding, k).result()
+
+    def similarity_search(self, query: str, k: int = 3) -> List[Document]:
+        """Embed and search for one query"""
+        return self.similarity_search_by_vector(self.embed_query(query), k)
+
     def refresh_database(self):
         """Force refresh the database with new documents"""
         try:
@@ -279,6 +402,7 @@ class DocumentDatabase:
     def cleanup(self):
         """Cleanup resources"""
         try:
+            self.search_batcher.close()
             if self.device == "cuda":
                 torch.cuda.empty_cache()
             logging.info("Database cleanup completed")
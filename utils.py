@@ -1,11 +1,28 @@
 import torch
 from torch.amp import autocast
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from contextlib import nullcontext, contextmanager
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer
+)
+from contextlib import nullcontext
 import logging
+import os
 import time
 import gc
+import hashlib
+import importlib.util
+import queue
+import string
+import threading
 import warnings
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Iterator, List, Optional, Union
 
 # Configure logging
 logging.basicConfig(
@@ -14,30 +31,85 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-@contextmanager
-def gpu_memory_manager():
-    """Context manager for GPU memory operations"""
-    try:
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        yield
-    finally:
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
+# Prefix of the message returned in place of code when generation or validation fails
+GENERATION_ERROR_PREFIX = "Error generating code"
+
+# Local generator checkpoint, also used by DocumentDatabase to pre-tokenize chunks
+MODEL_NAME = "./models/santacoder"
+
+# Full prompt sent to the model for a documentation-backed code request. The literal
+# text between fields is tokenized once in CodeGenerator.__init__.
+CODE_PROMPT_TEMPLATE = """
+Please provide clean, well-formatted {language} code for the following request.
+Use proper indentation and add explanatory comments.
+
+
+Task: Create {language} code for the following requirement:
+
+Based on the following documentation and requirements:
+
+Documentation Reference:
+{context}
+
+User Request:
+{user_query}
+
+Technical Requirements:
+1. Language: {language}
+2. Include error handling
+3. Add input validation
+4. Use proper documentation
+5. Follow coding standards
+
+Please generate a complete, well-documented solution.
+
+
+Requirements:
+1. Use clean, readable {language} code
+2. Include comprehensive comments
+3. Follow {language} best practices
+4. Implement proper error handling
+5. Use meaningful variable/function names
+
+Additional Context:
+- Code should be well-structured and maintainable
+- Include necessary imports/dependencies
+- Add input validation where appropriate
+- Consider edge cases
+
+Please provide the implementation below:
+
+
+Response format:
+{language}
+"""
 
 class PerformanceMonitor:
-    """Monitor and log performance metrics"""
-    def __init__(self):
-        self.times = {}
+    """Monitor and log performance metrics, only when APP_PROFILE=1"""
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get("APP_PROFILE") == "1"
+        self.enabled = enabled
+        # Per thread, so one shared monitor can time concurrent sessions
+        self._local = threading.local()
+    
+    @property
+    def times(self):
+        if not hasattr(self._local, "times"):
+            self._local.times = {}
+        return self._local.times
     
     def start(self, operation):
-        self.times[operation] = time.time()
+        if not self.enabled:
+            return
+        self.times[operation] = time.perf_counter()
     
     def end(self, operation):
+        if not self.enabled:
+            return
         if operation in self.times:
-            elapsed = time.time() - self.times[operation]
-            logging.info(f"{operation} took {elapsed:.2f} seconds")
+            elapsed = time.perf_counter() - self.times[operation]
+            logging.info("%s took %.2f seconds", operation, elapsed)
             del self.times[operation]
 
 class GPUManager:
@@ -65,6 +137,108 @@ def clear_memory():
         torch.cuda.empty_cache()
         torch.cuda.synchronize()
 
+class LRUCache:
+    """Thread-safe least-recently-used cache keyed by compact digests"""
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> bytes:
+        """Hash the parts into a 16 byte key so large prompts are not stored as keys"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else str(part).encode())
+            digest.update(b"\0")
+        return digest.digest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class MicroBatcher:
+    """Collect concurrent requests and process them together on a background thread"""
+    def __init__(self, process_batch: Callable, max_batch_size: int = 4, max_latency: float = 0.02):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, *args) -> Future:
+        """Queue one request; the future resolves to its entry in the batch result"""
+        future = Future()
+        self._queue.put((args, future))
+        return future
+
+    def close(self):
+        """Stop the worker thread once queued requests are processed"""
+        self._queue.put(None)
+
+    def _next_batch(self):
+        """Block for one request, then gather more until the batch is full or the window closes"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            
+            # Drop requests whose callers cancelled while waiting
+            batch = [(args, future) for args, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            
+            # Transpose per-request arguments into one list per parameter
+            columns = [list(column) for column in zip(*(args for args, _ in batch))]
+            try:
+                results = self.process_batch(*columns)
+            except Exception as e:
+                logging.error("Error processing batch of %d: %s", len(batch), e)
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+class StopOnEvent(StoppingCriteria):
+    """Stop generation once the event is set, e.g. when a stream's consumer goes away"""
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
 class CodeGenerator:
     """Generate code using the model"""
     def __init__(self):
@@ -73,15 +247,19 @@ class CodeGenerator:
         warnings.filterwarnings("ignore", category=DeprecationWarning)
         
         try:
-            self.model_name = "./models/santacoder"
+            self.model_name = MODEL_NAME
             
             # CUDA setup with error handling
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
-            self.dtype = torch.float16 if self.device == "cuda" else torch.float32
+            # BF16 halves weight bandwidth like FP16 but keeps FP32's exponent range
+            if self.device == "cuda":
+                self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            else:
+                self.dtype = torch.float32
             
-            logging.info(f"Initializing CodeGenerator on {self.device}")
+            logging.info("Initializing CodeGenerator on %s", self.device)
             if self.device == "cuda":
-                logging.info(f"CUDA Device: {torch.cuda.get_device_name(0)}")
+                logging.info("CUDA Device: %s", torch.cuda.get_device_name(0))
             
             # Initialize tokenizer with padding
             self.tokenizer = AutoTokenizer.from_pretrained(
@@ -92,31 +270,152 @@ class CodeGenerator:
             )
             self.tokenizer.pad_token = self.tokenizer.eos_token
             
+            # Pre-tokenize the fixed parts of the prompt template so requests only
+            # tokenize their own language, query and context
+            self._prompt_segments = self._tokenize_template(CODE_PROMPT_TEMPLATE)
+            self._language_ids = {}
+            self._explanation_suffix_ids = {}
+            
+            # Quantize weights to 4-bit NF4 when bitsandbytes is installed; decode reads
+            # every weight once per token, so smaller weights mean faster steps
+            self.quantized = self.device == "cuda" and importlib.util.find_spec("bitsandbytes") is not None
+            quantization_config = None
+            if self.quantized:
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=self.dtype,
+                    bnb_4bit_quant_type="nf4"
+                )
+                logging.info("Loading model with 4-bit NF4 quantization")
+            
             # Load model with optimizations
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.model_name,
                 torch_dtype=self.dtype,
                 device_map="auto",
                 local_files_only=True,
-                low_cpu_mem_usage=True
+                low_cpu_mem_usage=True,
+                quantization_config=quantization_config
             )
             
             # Optimize for GPU if available
             if self.device == "cuda":
-                self.model.to(self.device)
+                # Quantized models are already placed by device_map and cannot be moved
+                if not self.quantized:
+                    self.model.to(self.device)
                 torch.cuda.empty_cache()
-                logging.info(f"GPU Memory Allocated: {torch.cuda.memory_allocated(0)/1024**2:.2f}MB")
-                logging.info(f"GPU Memory Reserved: {torch.cuda.memory_reserved(0)/1024**2:.2f}MB")
+                logging.info("GPU Memory Allocated: %.2fMB", torch.cuda.memory_allocated(0)/1024**2)
+                logging.info("GPU Memory Reserved: %.2fMB", torch.cuda.memory_reserved(0)/1024**2)
+            
+            # Prompts are truncated so prompt plus new tokens fit the model's context window;
+            # explanation requests also leave room for the continuation in explain_from_cache()
+            self.context_window = getattr(self.model.config, "n_positions", None) or 2048
+            self.explanation_tokens = 300
+            self.explanation_reserve = self.explanation_tokens + 32
+            
+            # Batched prompts are padded up to a multiple of this many tokens so repeated
+            # requests reuse the same tensor shapes and caching allocator blocks
+            self.length_bucket = 128
+            
+            # One generate call at a time across the batcher, streams and explanations
+            self._generate_lock = threading.Lock()
+            
+            # Batch concurrent requests into shared generate calls. The worker only holds a
+            # weak reference so the model can be released when this generator is dropped.
+            batch_fn = weakref.WeakMethod(self.generate_code_batch)
+            self.batcher = MicroBatcher(lambda *columns: batch_fn()(*columns))
                 
         except Exception as e:
-            logging.error(f"Error in initialization: {str(e)}")
+            logging.error("Error in initialization: %s", e)
             raise
 
-    def generate_code(self, prompt, max_length=500, language="python"):
-        """Generate code with improved quality and formatting"""
-        try:
-            with gpu_memory_manager():
-                formatted_prompt = f"""
+    def _autocast(self):
+        """Autocast to the model dtype on CUDA, no-op on CPU"""
+        if self.device == "cuda":
+            return autocast('cuda', dtype=self.dtype)
+        return nullcontext()
+
+    def _generate(self, **kwargs):
+        """model.generate, serialized with every other generation on this model"""
+        with self._generate_lock:
+            return self.model.generate(**kwargs)
+
+    def _tokenize_template(self, template):
+        """Split a format template into (literal token IDs, field name, field prefix) segments"""
+        segments = []
+        for literal, field, _, _ in string.Formatter().parse(template):
+            # A space before a field belongs to the field's first token in BPE, so move it over
+            prefix = ""
+            if field is not None and literal.endswith(" "):
+                literal, prefix = literal[:-1], " "
+            literal_ids = self.tokenizer(literal, add_special_tokens=False).input_ids if literal else []
+            segments.append((literal_ids, field, prefix))
+        return segments
+
+    def encode_prompt(
+        self,
+        language: str,
+        user_query: str,
+        context: str = "",
+        context_ids: Optional[List[int]] = None
+    ) -> List[int]:
+        """Build prompt token IDs from the pre-tokenized template
+
+        Truncation to the context window happens at generation time in _prompt_ids().
+        Pass context_ids (e.g. from DocumentDatabase.context_ids) to skip tokenizing the context.
+        """
+        values = {"language": language, "user_query": user_query, "context": context}
+        input_ids = []
+        for literal_ids, field, prefix in self._prompt_segments:
+            input_ids.extend(literal_ids)
+            if field is None:
+                continue
+            if field == "context" and context_ids is not None:
+                input_ids.extend(context_ids)
+                continue
+            text = prefix + values[field]
+            if field == "language":
+                # Only a handful of languages, so keep their IDs around
+                if text not in self._language_ids:
+                    self._language_ids[text] = self.tokenizer(text, add_special_tokens=False).input_ids
+                input_ids.extend(self._language_ids[text])
+            else:
+                input_ids.extend(self.tokenizer(text, add_special_tokens=False).input_ids)
+        return input_ids
+
+    def _prompt_ids(
+        self,
+        prompt: Union[str, List[int]],
+        max_new_tokens: int,
+        reserve: int = 0,
+        bucket: Optional[int] = None
+    ) -> List[int]:
+        """Token IDs for a text prompt or IDs from encode_prompt(), left-truncated so that
+        max_new_tokens (plus any reserved tokens) still fit in the context window
+
+        Pass the bucket size when the prompt will be padded to a multiple of it; the budget
+        is rounded down so the padded prompt still fits.
+        """
+        if isinstance(prompt, str):
+            prompt = self.tokenizer(prompt).input_ids
+        budget = self.context_window - max_new_tokens - reserve
+        if bucket:
+            budget -= budget % bucket
+        return prompt[-budget:]
+
+    def _pad_inputs(self, prompt_ids: List[List[int]], pad_to_multiple_of: Optional[int] = None):
+        """Left-pad token ID lists into model inputs on the generator's device"""
+        inputs = self.tokenizer.pad(
+            {"input_ids": prompt_ids},
+            padding=True,
+            pad_to_multiple_of=pad_to_multiple_of,
+            return_tensors="pt"
+        )
+        return {k: v.to(self.device) for k, v in inputs.items()}
+
+    def format_prompt(self, prompt, language="python"):
+        """Wrap a request in the instruction template used for code generation"""
+        return f"""
 Please provide clean, well-formatted {language} code for the following request.
 Use proper indentation and add explanatory comments.
 
@@ -125,67 +424,291 @@ Use proper indentation and add explanatory comments.
 Response format:
 {language}
 """
+
+    def postprocess_code(self, generated_code):
+        """Extract the code block from raw model output and validate it"""
+        # Extract code from between backticks
+        code_pattern = "```"
+        if code_pattern in generated_code:
+            code_blocks = generated_code.split(code_pattern)
+            if len(code_blocks) >= 3:
+                generated_code = code_blocks[1]
+                if generated_code.startswith(('python', 'javascript', 'java', 'cpp', 'sql')):
+                    generated_code = generated_code.split('\n', 1)[1]
+        
+        # Clean up and validate
+        generated_code = generated_code.strip()
+        if not ModelUtils.validate_output(generated_code):
+            raise ValueError("Generated code appears to be invalid or too short")
+        
+        return generated_code
+
+    def postprocess_variants(self, completions: List[str]) -> List[str]:
+        """Post-process several completions, reporting invalid ones in place of failing all"""
+        variants = []
+        for completion in completions:
+            try:
+                variants.append(self.postprocess_code(completion))
+            except ValueError as e:
+                variants.append(f"{GENERATION_ERROR_PREFIX}: {str(e)}")
+        return variants
+
+    def generate_code(self, prompt, max_length=500, language="python", return_past_kv=False, num_return_sequences=1):
+        """Generate code with improved quality and formatting
+
+        prompt is either request text, which is wrapped with format_prompt(), or token
+        IDs from encode_prompt(). max_length is the number of new tokens to generate.
+        With num_return_sequences > 1, a list of code variants sampled from one prefill is
+        returned instead of a single string. With return_past_kv=True, returns
+        (code, (sequences, past_key_values)) so a follow-up generation can continue from
+        the cached prefix without re-prefilling it.
+        """
+        try:
+            with torch.inference_mode(), self._autocast():
+                if isinstance(prompt, str):
+                    prompt = self.format_prompt(prompt, language)
+                
+                # Tokenize with proper truncation and move inputs to correct device
+                reserve = self.explanation_reserve if return_past_kv else 0
+                inputs = self._pad_inputs([self._prompt_ids(prompt, max_length, reserve)])
                 
-                # Tokenize with proper truncation
-                inputs = self.tokenizer(
-                    formatted_prompt,
-                    return_tensors="pt",
-                    truncation=True,
-                    max_length=max_length,
-                    padding=True
+                # Generate with optimized parameters. Beam search reorders the cache across
+                # beams, so a single sequence is decoded when the cache is handed back.
+                outputs = self._generate(
+                    **inputs,
+                    max_new_tokens=max_length,
+                    temperature=0.4,
+                    top_p=0.85,
+                    top_k=50,
+                    num_beams=1 if return_past_kv else 5,
+                    no_repeat_ngram_size=3,
+                    do_sample=True,
+                    num_return_sequences=num_return_sequences,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    repetition_penalty=1.2,
+                    use_cache=True,
+                    return_dict_in_generate=return_past_kv
                 )
+                sequences = outputs.sequences if return_past_kv else outputs
                 
-                # Move inputs to correct device
-                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                # Decode only the new tokens, not the echoed prompt
+                prompt_length = inputs["input_ids"].shape[1]
+                completions = self.tokenizer.batch_decode(
+                    sequences[:, prompt_length:],
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=True
+                )
+                if num_return_sequences == 1:
+                    generated_code = self.postprocess_code(completions[0])
+                else:
+                    generated_code = self.postprocess_variants(completions)
                 
-                # Generate with optimized parameters
-                with autocast('cuda') if self.device == "cuda" else nullcontext():
-                    outputs = self.model.generate(
+                if return_past_kv:
+                    return generated_code, (sequences, outputs.past_key_values)
+                return generated_code
+            
+        except torch.cuda.OutOfMemoryError:
+            raise
+        except Exception as e:
+            logging.error("Error in code generation: %s", e)
+            error_message = f"{GENERATION_ERROR_PREFIX}: {str(e)}"
+            return (error_message, None) if return_past_kv else error_message
+
+    def generate_code_stream(self, prompt, max_length=500, language="python", result: Optional[dict] = None) -> Iterator[str]:
+        """Yield decoded text chunks while generation runs on a background thread
+
+        If a dict is passed as result, the finished (sequences, past_key_values) are stored
+        under "generation" so explain_from_cache() can continue from them. Closing the
+        iterator early stops the background generation at the next decoding step.
+        """
+        if isinstance(prompt, str):
+            prompt = self.format_prompt(prompt, language)
+        with torch.inference_mode():
+            reserve = self.explanation_reserve if result is not None else 0
+            inputs = self._pad_inputs([self._prompt_ids(prompt, max_length, reserve)])
+        
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True
+        )
+        errors = []
+        # Set when the consumer stops iterating, so an abandoned stream does not keep
+        # decoding up to max_length while holding the model
+        stop = threading.Event()
+        
+        def _worker():
+            try:
+                # inference_mode and autocast are thread local, so enter them on the worker
+                with torch.inference_mode(), self._autocast():
+                    # Streamers cannot follow beam search, so sample a single sequence
+                    outputs = self._generate(
                         **inputs,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)]),
                         max_new_tokens=max_length,
                         temperature=0.4,
                         top_p=0.85,
                         top_k=50,
-                        num_beams=5,
+                        num_beams=1,
                         no_repeat_ngram_size=3,
                         do_sample=True,
                         num_return_sequences=1,
                         pad_token_id=self.tokenizer.eos_token_id,
                         eos_token_id=self.tokenizer.eos_token_id,
-                        repetition_penalty=1.2
+                        repetition_penalty=1.2,
+                        use_cache=True,
+                        return_dict_in_generate=True
                     )
-                
-                generated_code = self.tokenizer.decode(
-                    outputs[0],
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=True
-                )
-                
-                # Extract code from between backticks
-                code_pattern = "```"
-                if code_pattern in generated_code:
-                    code_blocks = generated_code.split(code_pattern)
-                    if len(code_blocks) >= 3:
-                        generated_code = code_blocks[1]
-                        if generated_code.startswith(('python', 'javascript', 'java', 'cpp', 'sql')):
-                            generated_code = generated_code.split('\n', 1)[1]
-                
-                # Clean up and validate
-                generated_code = generated_code.strip()
-                if not ModelUtils.validate_output(generated_code):
-                    raise ValueError("Generated code appears to be invalid or too short")
-                
-                return generated_code
-                
-        except Exception as e:
-            logging.error(f"Error in code generation: {str(e)}")
-            return f"Error generating code: {str(e)}"
+                if result is not None:
+                    result["generation"] = (outputs.sequences, outputs.past_key_values)
+            except Exception as e:
+                logging.error("Error in streamed code generation: %s", e)
+                errors.append(e)
+                # Unblock the consumer, generate only ends the stream on success
+                streamer.end()
+        
+        thread = threading.Thread(target=_worker, daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            # Runs on normal completion and when the caller closes or drops the iterator
+            stop.set()
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    @torch.inference_mode()
+    def explain_from_cache(self, generation, language="python", max_new_tokens=None, rows=None):
+        """Explain freshly generated code by continuing from its cached keys/values
 
+        Returns one explanation, or a list with one per variant when the generation
+        holds several sequences. Pass rows to explain only those variants; a list with
+        one explanation per selected row is returned.
+        """
+        sequences, past_key_values = generation
+        if rows is not None:
+            index = torch.tensor(rows, device=sequences.device)
+            sequences = sequences.index_select(0, index)
+            past_key_values = self._select_cache_rows(past_key_values, index)
+        if language not in self._explanation_suffix_ids:
+            suffix = "".join(("\n\nNow explain the above ", language, " code.\n\nExplanation:\n"))
+            self._explanation_suffix_ids[language] = self.tokenizer(suffix, return_tensors="pt").input_ids
+        suffix_ids = self._explanation_suffix_ids[language].to(sequences.device).expand(sequences.shape[0], -1)
+        
+        # Only the suffix tokens are new; generate skips the prefix already in past_key_values.
+        # Variants that finished early are padded with EOS, which stays masked out.
+        input_ids = torch.cat([sequences, suffix_ids], dim=-1)
+        attention_mask = torch.cat(
+            [(sequences != self.tokenizer.pad_token_id).long(), torch.ones_like(suffix_ids)],
+            dim=-1
+        )
+        if max_new_tokens is None:
+            max_new_tokens = self.explanation_tokens
+        max_new_tokens = min(max_new_tokens, self.context_window - input_ids.shape[1])
+        if max_new_tokens <= 0:
+            raise ValueError("No room left in the context window for an explanation")
+        
+        with self._autocast():
+            outputs = self._generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                temperature=0.3,
+                top_p=0.85,
+                top_k=50,
+                num_beams=1,
+                no_repeat_ngram_size=3,
+                do_sample=True,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.eos_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                repetition_penalty=1.2,
+                use_cache=True
+            )
+        
+        explanations = [
+            explanation.strip()
+            for explanation in self.tokenizer.batch_decode(
+                outputs[:, input_ids.shape[1]:],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True
+            )
+        ]
+        return explanations if rows is not None or len(explanations) > 1 else explanations[0]
+
+    def _select_cache_rows(self, past_key_values, index):
+        """Keep only the given batch rows of a KV cache, legacy tuples or Cache objects"""
+        if hasattr(past_key_values, "batch_select_indices"):
+            past_key_values.batch_select_indices(index)
+            return past_key_values
+        if torch.is_tensor(past_key_values):
+            return past_key_values.index_select(0, index)
+        return type(past_key_values)(self._select_cache_rows(layer, index) for layer in past_key_values)
+
+    @torch.inference_mode()
+    def generate_code_batch(
+        self,
+        prompts: List[Union[str, List[int]]],
+        max_lengths: List[int],
+        num_sequences: Optional[List[int]] = None
+    ) -> List[List[str]]:
+        """Generate completions for several prompts with a single model.generate call
+
+        Each prompt is raw text or token IDs from encode_prompt(). Returns a list of
+        num_sequences[i] completions per prompt (one each by default).
+        """
+        if num_sequences is None:
+            num_sequences = [1] * len(prompts)
+        num_return_sequences = max(num_sequences)
+        
+        inputs = self._pad_inputs(
+            [self._prompt_ids(prompt, max(max_lengths), bucket=self.length_bucket) for prompt in prompts],
+            pad_to_multiple_of=self.length_bucket
+        )
+        
+        with self._autocast():
+            outputs = self._generate(
+                **inputs,
+                max_new_tokens=max(max_lengths),
+                temperature=0.4,
+                top_p=0.85,
+                top_k=50,
+                num_beams=5,
+                no_repeat_ngram_size=3,
+                do_sample=True,
+                num_return_sequences=num_return_sequences,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                repetition_penalty=1.2
+            )
+        
+        # Prompts are left padded to a common width, so every completion starts at the same
+        # offset. Rows come back grouped by prompt, num_return_sequences rows each.
+        prompt_length = inputs["input_ids"].shape[1]
+        results = []
+        for i, (length, count) in enumerate(zip(max_lengths, num_sequences)):
+            rows = outputs[i * num_return_sequences:i * num_return_sequences + count]
+            results.append(self.tokenizer.batch_decode(
+                rows[:, prompt_length:prompt_length + length],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True
+            ))
+        return results
+
+    def submit(self, prompt: Union[str, List[int]], max_length: int, num_sequences: int = 1) -> Future:
+        """Queue a prompt for batched generation; resolves to a list of raw completions"""
+        return self.batcher.submit(prompt, max_length, num_sequences)
+
+    @torch.inference_mode()
     def generate_explanation(self, code):
         """Generate explanation for the code with improved clarity"""
         try:
-            with gpu_memory_manager():
-                prompt = f"""
+            prompt = f"""
 Please provide a clear, detailed explanation of the following code:
 
 {code}
@@ -197,53 +720,57 @@ Explain:
 
 Explanation:
 """
-                inputs = self.tokenizer(
-                    prompt,
-                    return_tensors="pt",
-                    truncation=True,
-                    max_length=500,
-                    padding=True
-                ).to(self.device)
-                
-                with autocast('cuda') if self.device == "cuda" else nullcontext():
-                    outputs = self.model.generate(
-                        **inputs,
-                        max_new_tokens=300,
-                        temperature=0.3,
-                        top_p=0.85,
-                        top_k=50,
-                        num_beams=3,
-                        no_repeat_ngram_size=3,
-                        do_sample=True,
-                        num_return_sequences=1,
-                        repetition_penalty=1.2
-                    )
-                
-                explanation = self.tokenizer.decode(
-                    outputs[0],
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=True
+            inputs = self.tokenizer(
+                prompt,
+                return_tensors="pt",
+                truncation=True,
+                max_length=500,
+                padding=True
+            ).to(self.device)
+            
+            with self._autocast():
+                outputs = self._generate(
+                    **inputs,
+                    max_new_tokens=300,
+                    temperature=0.3,
+                    top_p=0.85,
+                    top_k=50,
+                    num_beams=3,
+                    no_repeat_ngram_size=3,
+                    do_sample=True,
+                    num_return_sequences=1,
+                    repetition_penalty=1.2
                 )
-                
-                # Clean up and validate
-                explanation = explanation.replace("Explanation:", "").strip()
-                if len(explanation) < 20:
-                    raise ValueError("Generated explanation appears to be too short")
-                
-                return explanation
-                
+            
+            explanation = self.tokenizer.decode(
+                outputs[0],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True
+            )
+            
+            # Clean up and validate
+            explanation = explanation.replace("Explanation:", "").strip()
+            if len(explanation) < 20:
+                raise ValueError("Generated explanation appears to be too short")
+            
+            return explanation
+            
+        except torch.cuda.OutOfMemoryError:
+            raise
         except Exception as e:
-            logging.error(f"Error in explanation generation: {str(e)}")
+            logging.error("Error in explanation generation: %s", e)
             return f"Error generating explanation: {str(e)}"
 
     def __del__(self):
         """Cleanup when object is destroyed"""
         try:
+            if hasattr(self, 'batcher'):
+                self.batcher.close()
             if hasattr(self, 'device') and self.device == "cuda":
                 torch.cuda.empty_cache()
                 torch.cuda.synchronize()
         except Exception as e:
-            logging.error(f"Error during cleanup: {str(e)}")
+            logging.error("Error during cleanup: %s", e)
 
 class ModelUtils:
     """Utility functions for model operations"""
@@ -274,7 +801,7 @@ class ModelUtils:
             return code
             
         except Exception as e:
-            logging.error(f"Error formatting code: {str(e)}")
+            logging.error("Error formatting code: %s", e)
             return code
 
     @staticmethod
@@ -292,5 +819,5 @@ class ModelUtils:
                 return False
             return True
         except Exception as e:
-            logging.error(f"Error in validate_output: {str(e)}")
+            logging.error("Error in validate_output: %s", e)
             return False
\ No newline at end of file